@@ -1,106 +1,213 @@
+import gc
+import importlib
 import json
 import math
 import os
 import resource
+import select
 import signal
+import stat
+import sys
 import time
-from dataclasses import asdict, dataclass
-
-import click
-import landlock
-import prctl
+from dataclasses import dataclass
 
 VERSION = "24.1"
 
 
-@click.command(
-    help=f"Run program with parent version {VERSION}.",
-    context_settings={
-        "allow_interspersed_args": False,
-    },
-)
-@click.option(
-    "-m",
-    "--memory",
-    type=int,
-    help="The program's maximum memory address space in kilobytes.",
-)
-@click.option(
-    "-t",
-    "--cpu-time",
-    type=int,
-    help="The program's maximum CPU time in milliseconds.",
-)
-@click.option(
-    "-r",
-    "--real-time",
-    type=int,
-    help="The program's maximum real-time execution time in milliseconds.",
-)
-@click.option("--stack", type=int, help="The program's stack size limit in kilobytes.")
-@click.option(
-    "-f",
-    "--file-size",
-    type=int,
-    help="The program's maximum file size in kilobytes that it can create or modify.",
-)
-@click.option(
-    "-p",
-    "--processes",
-    type=int,
-    help="The number of threads, or processes, the program can use.",
-)
-@click.option(
-    "--stdin",
-    help="Redirect a file to the program's stdin.",
-    type=click.Path(exists=True, dir_okay=False, readable=True),
-)
-@click.option(
-    "--stdout",
-    help="Redirect the program's stdout to a file.",
-    type=click.Path(dir_okay=False, writable=True),
-)
-@click.option(
-    "--stderr",
-    help="Redirect the program's stderr to a file.",
-    type=click.Path(dir_okay=False, writable=True),
-)
-@click.option(
-    "--stderr-to-stdout", help="Redirect the program's stderr to stdout.", is_flag=True
-)
-@click.option(
-    "-s",
-    "--stats",
-    help="Save execution statistics to a file.",
-    type=click.File(mode="w"),
-)
-@click.option(
-    "--fs-readonly",
-    help="Allow the program read from files located under the provided path.",
-    multiple=True,
-)
-@click.option(
-    "--fs-readwrite",
-    help="Allow the program write to files located under the provided path.",
-    multiple=True,
-)
-@click.option(
-    "--env", help="Set an environment variable.", type=(str, str), multiple=True
-)
-@click.option("--empty-env", help="Do not inherit parent's environment.", is_flag=True)
-@click.option("--drop-caps", help="Drop the program's capabilities.", is_flag=True)
-@click.argument("program")
-@click.argument("args", nargs=-1, type=click.UNPROCESSED)
-def run(stats, **kwargs):
-    pid = os.fork()
-    if pid == 0:  # Child process
-        child(**kwargs)
-    else:
-        run_stats = parent(pid, **kwargs)
+def run():
+    # click is only needed for --help and invalid arguments, so it is not
+    # imported by the common path handled in main
+    import click
+
+    @click.command(
+        help=f"Run program with parent version {VERSION}.",
+        context_settings={
+            "allow_interspersed_args": False,
+        },
+    )
+    @click.option(
+        "-m",
+        "--memory",
+        type=int,
+        help="The program's maximum memory address space in kilobytes.",
+    )
+    @click.option(
+        "-t",
+        "--cpu-time",
+        type=int,
+        help="The program's maximum CPU time in milliseconds.",
+    )
+    @click.option(
+        "-r",
+        "--real-time",
+        type=int,
+        help="The program's maximum real-time execution time in milliseconds.",
+    )
+    @click.option(
+        "--stack", type=int, help="The program's stack size limit in kilobytes."
+    )
+    @click.option(
+        "-f",
+        "--file-size",
+        type=int,
+        help="The program's maximum file size in kilobytes that it can create or modify.",
+    )
+    @click.option(
+        "-p",
+        "--processes",
+        type=int,
+        help="The number of threads, or processes, the program can use.",
+    )
+    @click.option(
+        "--stdin",
+        help="Redirect a file to the program's stdin.",
+        type=click.Path(exists=True, dir_okay=False, readable=True),
+    )
+    @click.option(
+        "--stdout",
+        help="Redirect the program's stdout to a file.",
+        type=click.Path(dir_okay=False, writable=True),
+    )
+    @click.option(
+        "--stderr",
+        help="Redirect the program's stderr to a file.",
+        type=click.Path(dir_okay=False, writable=True),
+    )
+    @click.option(
+        "--stderr-to-stdout",
+        help="Redirect the program's stderr to stdout.",
+        is_flag=True,
+    )
+    @click.option(
+        "-s",
+        "--stats",
+        help="Save execution statistics to a file.",
+        type=click.File(mode="w"),
+    )
+    @click.option(
+        "--fs-readonly",
+        help="Allow the program read from files located under the provided path.",
+        multiple=True,
+    )
+    @click.option(
+        "--fs-readwrite",
+        help="Allow the program write to files located under the provided path.",
+        multiple=True,
+    )
+    @click.option(
+        "--env", help="Set an environment variable.", type=(str, str), multiple=True
+    )
+    @click.option(
+        "--empty-env", help="Do not inherit parent's environment.", is_flag=True
+    )
+    @click.option("--drop-caps", help="Drop the program's capabilities.", is_flag=True)
+    @click.argument("program")
+    @click.argument("args", nargs=-1, type=click.UNPROCESSED)
+    def command(stats, **kwargs):
+        run_stats = execute(**kwargs)
         if stats:
-            json.dump(asdict(run_stats), stats)
+            json.dump(run_stats.to_dict(), stats)
         exit(run_stats.exit_code)
 
+    command()
+
+
+# option name -> (keyword, number of values, converter, can be repeated),
+# used by parse_args to handle the common invocations without click
+FAST_OPTIONS = {
+    "-m": ("memory", 1, int, False),
+    "--memory": ("memory", 1, int, False),
+    "-t": ("cpu_time", 1, int, False),
+    "--cpu-time": ("cpu_time", 1, int, False),
+    "-r": ("real_time", 1, int, False),
+    "--real-time": ("real_time", 1, int, False),
+    "--stack": ("stack", 1, int, False),
+    "-f": ("file_size", 1, int, False),
+    "--file-size": ("file_size", 1, int, False),
+    "-p": ("processes", 1, int, False),
+    "--processes": ("processes", 1, int, False),
+    "--stdin": ("stdin", 1, str, False),
+    "--stdout": ("stdout", 1, str, False),
+    "--stderr": ("stderr", 1, str, False),
+    "--stderr-to-stdout": ("stderr_to_stdout", 0, bool, False),
+    "-s": ("stats", 1, str, False),
+    "--stats": ("stats", 1, str, False),
+    "--fs-readonly": ("fs_readonly", 1, str, True),
+    "--fs-readwrite": ("fs_readwrite", 1, str, True),
+    "--env": ("env", 2, str, True),
+    "--empty-env": ("empty_env", 0, bool, False),
+    "--drop-caps": ("drop_caps", 0, bool, False),
+}
+
+
+def parse_args(argv):
+    # returns None for anything unusual, so that click can handle it properly
+    options = {
+        keyword: () if multiple else (False if nargs == 0 else None)
+        for keyword, nargs, _, multiple in FAST_OPTIONS.values()
+    }
+
+    i = 0
+    while i < len(argv) and argv[i].startswith("-"):
+        if argv[i] == "--":
+            i += 1
+            break
+
+        spec = FAST_OPTIONS.get(argv[i])
+        if spec is None:
+            return None
+        keyword, nargs, converter, multiple = spec
+
+        if nargs == 0:
+            value = True
+        else:
+            values = argv[i + 1 : i + 1 + nargs]
+            if len(values) != nargs:
+                return None
+            try:
+                values = tuple(converter(v) for v in values)
+            except ValueError:
+                return None
+            value = values if nargs > 1 else values[0]
+
+        if multiple:
+            options[keyword] += (value,)
+        else:
+            options[keyword] = value
+        i += 1 + nargs
+
+    if i == len(argv):
+        return None
+    options["program"] = argv[i]
+    options["args"] = tuple(argv[i + 1 :])
+
+    # leave path validation and its error reporting to click
+    stdin = options["stdin"]
+    if stdin and not (os.path.isfile(stdin) and os.access(stdin, os.R_OK)):
+        return None
+    for path in (options["stdout"], options["stderr"]):
+        if path and os.path.exists(path):
+            if os.path.isdir(path) or not os.access(path, os.W_OK):
+                return None
+
+    return options
+
+
+def main():
+    options = parse_args(sys.argv[1:])
+    if options is None:
+        run()
+        return
+
+    stats = options.pop("stats")
+    run_stats = execute(**options)
+    if stats == "-":  # same as click.File
+        json.dump(run_stats.to_dict(), sys.stdout)
+    elif stats:
+        with open(stats, "w") as f:
+            json.dump(run_stats.to_dict(), f)
+    exit(run_stats.exit_code)
+
 
 @dataclass
 class RunStats:
@@ -110,28 +217,89 @@ class RunStats:
     real_time: int
     timeouted: bool
 
+    def to_dict(self) -> dict:
+        return {
+            "exit_code": self.exit_code,
+            "max_rss": self.max_rss,
+            "cpu_time": self.cpu_time,
+            "real_time": self.real_time,
+            "timeouted": self.timeouted,
+        }
 
-def parent(pid, real_time, cpu_time, **_) -> RunStats:
-    def kill_child(sig, frame):
-        os.kill(pid, signal.SIGKILL)
 
-    if real_time:
+def execute(program, args, env, empty_env, **kwargs) -> RunStats:
+    # encode the arguments and environment once, so execve does not have to
+    argv = (os.fsencode(os.path.basename(program)),) + tuple(map(os.fsencode, args))
+    env = [(os.fsencode(k), os.fsencode(v)) for k, v in env]
+    if empty_env:
+        process_env = dict(env)
+    elif env:
+        process_env = os.environb.copy()
+        process_env.update(env)
+    else:
+        process_env = os.environb
+
+    # the sandboxing modules are only imported when needed, but before forking,
+    # so that loading them does not count towards the program's limits
+    if kwargs["fs_readonly"] or kwargs["fs_readwrite"]:
+        importlib.import_module("landlock")
+    if kwargs["drop_caps"]:
+        importlib.import_module("prctl")
+
+    pid = os.fork()
+    if pid == 0:  # Child process
+        # a garbage collection would write to the shared objects and make the
+        # kernel copy their pages, nothing needs to be freed before execve
+        gc.disable()
+        child(program=program, argv=argv, process_env=process_env, **kwargs)
+    return parent(pid, **kwargs)
+
+
+def wait_for_child(pid, real_time) -> bool:
+    # returns True if the child was killed for exceeding the real-time limit
+    if not real_time:
+        return False
+
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # pidfd_open is not available (kernel < 5.3), fall back to SIGALRM
+        def kill_child(sig, frame):
+            os.kill(pid, signal.SIGKILL)
+
         signal.signal(signal.SIGALRM, kill_child)
         signal.setitimer(signal.ITIMER_REAL, real_time / 1000)
+        return False
 
-    start = time.time()
-    _, exitstatus = os.waitpid(pid, 0)
-    duration = time.time() - start
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if poller.poll(real_time):
+            return False
+        # unlike a pid, the pidfd cannot be reused by another process
+        signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+        return True
+    finally:
+        os.close(pidfd)
+
+
+def parent(pid, real_time, cpu_time, **_) -> RunStats:
+    monotonic_ns = time.monotonic_ns
+    start_ns = monotonic_ns()
+    killed = wait_for_child(pid, real_time)
+    _, exitstatus, usage = os.wait4(pid, 0)
+    duration_ns = monotonic_ns() - start_ns
     exit_code = os.waitstatus_to_exitcode(exitstatus)
-    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
 
     cpu_time_ms = int(usage.ru_utime * 1000)
-    duration_ms = int(duration * 1000)
+    duration_ms = duration_ns // 1_000_000
     max_rss_kilobytes = int(usage.ru_maxrss * 1.024)  # rusage is in KiB
 
     timeouted = False
 
-    if real_time and duration_ms >= real_time:
+    if killed:
+        timeouted = True
+    elif real_time and duration_ms >= real_time:
         timeouted = True
     elif cpu_time and cpu_time_ms >= cpu_time:
         timeouted = True
@@ -146,94 +314,119 @@ def parent(pid, real_time, cpu_time, **_) -> RunStats:
     return RunStats(exit_code, max_rss_kilobytes, cpu_time_ms, duration_ms, timeouted)
 
 
+# option name, resource and the function converting the option to rlimit units
+RLIMITS = (
+    ("memory", resource.RLIMIT_AS, lambda kilobytes: kilobytes * 1000),
+    ("cpu_time", resource.RLIMIT_CPU, lambda ms: math.ceil(ms / 1000)),
+    ("file_size", resource.RLIMIT_FSIZE, lambda kilobytes: kilobytes * 1000),
+    ("processes", resource.RLIMIT_NPROC, lambda processes: processes),
+)
+
+
+def redirect(path, target_fd, flags):
+    # O_CLOEXEC makes sure the source descriptor never leaks into the program
+    fh = os.open(path, flags | os.O_CLOEXEC)
+    if fh == target_fd:
+        os.set_inheritable(fh, True)
+        return
+    os.dup2(fh, target_fd)
+    os.close(fh)
+
+
 def child(
-    memory,
     stack,
-    cpu_time,
-    file_size,
-    processes,
     program,
-    args,
+    argv,
+    process_env,
     stdin,
     stdout,
     stderr,
     stderr_to_stdout,
     fs_readonly,
     fs_readwrite,
-    env,
-    empty_env,
     drop_caps,
-    **_,
+    **options,
 ):
-    if memory:
-        memory_bytes = memory * 1000
-        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
-
-    if stack:
-        if stack > 0:
-            stack_bytes = stack * 1000
-            resource.setrlimit(resource.RLIMIT_STACK, (stack_bytes, stack_bytes))
-        elif stack < 0:
-            resource.setrlimit(
-                resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
-            )
-
-    if cpu_time:
-        cpu_time_secs = math.ceil(cpu_time / 1000)
-        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time_secs, cpu_time_secs))
-
-    if file_size:
-        file_size_bytes = file_size * 1000
-        resource.setrlimit(resource.RLIMIT_FSIZE, (file_size_bytes, file_size_bytes))
-
-    if processes:
-        resource.setrlimit(resource.RLIMIT_NPROC, (processes, processes))
-
-    # disable core dumps
+    for option, rlimit, convert in RLIMITS:
+        value = options.get(option)
+        if value:
+            limit = convert(value)
+            resource.setrlimit(rlimit, (limit, limit))
+
+    stack = stack or 0
+    if stack > 0:
+        stack_bytes = stack * 1000
+        resource.setrlimit(resource.RLIMIT_STACK, (stack_bytes, stack_bytes))
+    elif stack < 0:
+        resource.setrlimit(
+            resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
+        )
+
+    # disable core dumps, PR_SET_DUMPABLE cannot be used since execve resets it
     resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
 
     # file access limit
     if fs_readonly or fs_readwrite:
+        import landlock
+
+        readonly_rules = (
+            landlock.FSAccess.READ_FILE
+            | landlock.FSAccess.READ_DIR
+            | landlock.FSAccess.EXECUTE
+        )
+        file_rules = landlock.FSAccess.all_file()
+
+        # landlock only accepts file access rights for regular files, so mask
+        # them by type, and merge the rules of paths given multiple times
         rs = landlock.Ruleset()
-        if fs_readonly:
-            rs.allow(
-                *fs_readonly,
-                rules=landlock.FSAccess.READ_FILE
-                | landlock.FSAccess.READ_DIR
-                | landlock.FSAccess.EXECUTE,
-            )
-        if fs_readwrite:
-            rs.allow(*fs_readwrite)
+        is_dir = {}
+        path_rules = {}
+        for paths, rules in (
+            (fs_readonly, readonly_rules),
+            (fs_readwrite, rs.restrict_rules),
+        ):
+            for path in paths:
+                if path not in is_dir:
+                    is_dir[path] = stat.S_ISDIR(os.stat(path).st_mode)
+                mask = rules if is_dir[path] else rules & file_rules
+                path_rules[path] = path_rules.get(path, mask) | mask
+
+        # add paths sharing the same rules together
+        rules_paths = {}
+        for path, rules in path_rules.items():
+            rules_paths.setdefault(rules, []).append(path)
+        for rules, paths in rules_paths.items():
+            rs.allow(*paths, rules=rules)
         rs.apply()
 
     # drop all capabilities
     if drop_caps:
+        import prctl
+
         prctl.cap_permitted.limit()
         prctl.cap_inheritable.limit()
         prctl.cap_effective.limit()
         prctl.set_no_new_privs(1)
 
     if stdin:
-        fh = os.open(stdin, os.O_RDONLY)
-        os.dup2(fh, 0)
-        os.close(fh)
-
-    if stdout:
-        fh = os.open(stdout, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-        os.dup2(fh, 1)
-        os.close(fh)
+        redirect(stdin, 0, os.O_RDONLY)
 
-    if stderr:
-        fh = os.open(stderr, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-        os.dup2(fh, 2)
-        os.close(fh)
+    write_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if stdout and stdout == stderr:
+        # open the shared file once and point both streams at it
+        redirect(stdout, 1, write_flags)
+        os.dup2(1, 2)
+    else:
+        if stdout:
+            redirect(stdout, 1, write_flags)
+        if stderr:
+            redirect(stderr, 2, write_flags)
 
     if stderr_to_stdout:
         os.dup2(1, 2)
 
-    process_env = {}
-    if not empty_env:
-        process_env.update(os.environ)
-    process_env.update({k: v for k, v in env})
+    os.execve(program, argv, process_env)
+
 
-    os.execve(program, (os.path.basename(program),) + args, process_env)
+if __name__ == "__main__":
+    main()